@@ -6,6 +6,7 @@
 
 from comtypes import COMError
 import comtypes.client
+import weakref
 from hwPortUtils import SYSTEMTIME
 import scriptHandler
 import winKernel
@@ -57,32 +58,56 @@ importanceLabels={
 	0:_("low importance"),
 }
 
+# Labels used when reporting message list rows.
+# NVDA's language can only change on restart, so these are safe to translate once at import.
+# Translators: when an email is unread
+unreadLabel=_("unread")
+# Translators: when an email has attachments
+hasAttachmentLabel=_("has attachment")
+# Translators: the email is a meeting request
+meetingRequestLabel=_("meeting request")
+expandedLabel=controlTypes.stateLabels[controlTypes.STATE_EXPANDED]
+collapsedLabel=controlTypes.stateLabels[controlTypes.STATE_COLLAPSED]
+
+#: Maps (windowClassName, role) to a function taking an object and returning whether it has stuffed parents,
+#: in which case its grandparent window is used as its parent.
+stuffedParentsPredicates={
+	#The control showing plain text messages has very stuffed parents
+	("RichEdit20W",controlTypes.ROLE_EDITABLETEXT):lambda obj: obj.windowControlID==8224,
+	#The control that shows HTML messages has stuffed parents
+	("Internet Explorer_Server",controlTypes.ROLE_PANE):lambda obj: not isinstance(obj,MSHTML),
+}
+
+#: (windowClassName, controlID) pairs identifying the message list window.
+messageListWindowKeys=frozenset({("SUPERGRID",4704),("rctrl_renwnd32",109)})
+
+#: Roles of objects whose description should be removed.
+rolesWithoutDescription=frozenset({controlTypes.ROLE_MENUBAR,controlTypes.ROLE_MENUITEM})
+
+#: Roles of objects which should always allow IAccessible focus events.
+rolesAllowingIAccessibleFocusEvent=frozenset({controlTypes.ROLE_TREEVIEW,controlTypes.ROLE_TREEVIEWITEM,controlTypes.ROLE_LIST,controlTypes.ROLE_LISTITEM})
+
+# Translators: This is presented in outlook or live mail, email subject
+subjectTemplate=_("subject: %s")
+# Translators: This is presented in outlook or live mail, email received time
+receivedTemplate=_("received: %s")
+# Translators: This is presented in outlook or live mail, email sent date
+sentTemplate=_("sent: %s")
+
 def getContactString(obj):
-		return ", ".join([x for x in [obj.fullName,obj.companyName,obj.jobTitle,obj.email1address] if x and not x.isspace()])
+	return ", ".join(x for x in (obj.fullName,obj.companyName,obj.jobTitle,obj.email1address) if x and not x.isspace())
 
 def getReceivedMessageString(obj):
-	nameList=[]
-	nameList.append(obj.senderName)
-	# Translators: This is presented in outlook or live mail, email subject
-	nameList.append(_("subject: %s")%obj.subject)
-	# Translators: This is presented in outlook or live mail, email received time
-	nameList.append(_("received: %s")%obj.receivedTime)
-
-	text=", ".join(nameList)
-	if obj.unread:
-		text="%s %s"%(_("unread"),text)
+	prefix=""
 	if obj.attachments.count>0:
 		# Translators: This is presented in outlook or live mail, indicating email attachments
-		text="%s %s"%(_("attachment"),text)
-	return text
+		prefix=_("attachment")+" "
+	if obj.unread:
+		prefix+=unreadLabel+" "
+	return "%s%s, %s, %s"%(prefix,obj.senderName,subjectTemplate%obj.subject,receivedTemplate%obj.receivedTime)
 
 def getSentMessageString(obj):
-	nameList=[]
-	nameList.append(obj.to)
-	nameList.append(_("subject: %s")%obj.subject)
-	# Translators: This is presented in outlook or live mail, email sent date
-	nameList.append(_("sent: %s")%obj.sentOn)
-	return ", ".join(nameList)
+	return "%s, %s, %s"%(obj.to,subjectTemplate%obj.subject,sentTemplate%obj.sentOn)
 
 class AppModule(appModuleHandler.AppModule):
 
@@ -124,11 +149,12 @@ class AppModule(appModuleHandler.AppModule):
 
 	def _get_outlookVersion(self):
 		nativeOm=self.nativeOm
-		if nativeOm:
-			outlookVersion=int(nativeOm.version.split('.')[0])
-		else:
-			outlookVersion=0
-		return outlookVersion
+		if not nativeOm:
+			# Don't cache this, as the object model may become available later.
+			return 0
+		# The version can't change for the life of the process, so override the property with the result.
+		self.outlookVersion=int(nativeOm.version.split('.')[0])
+		return self.outlookVersion
 
 	def isBadUIAWindow(self,hwnd):
 		if winUser.getClassName(hwnd) in ("WeekViewWnd","DayViewWnd"):
@@ -136,22 +162,20 @@ class AppModule(appModuleHandler.AppModule):
 		return False
 
 	def event_NVDAObject_init(self,obj):
+		# This is called for every object, so use lookups rather than a chain of comparisons.
 		role=obj.role
 		windowClassName=obj.windowClassName
-		controlID=obj.windowControlID
-		#The control showing plain text messages has very stuffed parents
-		#Use the grandparent window as its parent
-		if role==controlTypes.ROLE_EDITABLETEXT and windowClassName=="RichEdit20W" and controlID==8224:
-			obj.parent=Window._get_parent(Window._get_parent(obj))
-		#The control that shows HTML messages has stuffed parents. Use the control's parent window as its parent
-		if windowClassName=="Internet Explorer_Server" and role==controlTypes.ROLE_PANE and not isinstance(obj,MSHTML):
+		hasStuffedParents=stuffedParentsPredicates.get((windowClassName,role))
+		if hasStuffedParents and hasStuffedParents(obj):
 			obj.parent=Window._get_parent(Window._get_parent(obj))
-		if role in (controlTypes.ROLE_MENUBAR,controlTypes.ROLE_MENUITEM):
+		if role in rolesWithoutDescription:
 			obj.description=None
-		if role in (controlTypes.ROLE_TREEVIEW,controlTypes.ROLE_TREEVIEWITEM,controlTypes.ROLE_LIST,controlTypes.ROLE_LISTITEM):
+		elif role in rolesAllowingIAccessibleFocusEvent:
 			obj.shouldAllowIAccessibleFocusEvent=True
-		if ((windowClassName=="SUPERGRID" and controlID==4704) or (windowClassName=="rctrl_renwnd32" and controlID==109)) and role==controlTypes.ROLE_UNKNOWN:
-			obj.role=controlTypes.ROLE_LISTITEM
+		elif role==controlTypes.ROLE_UNKNOWN:
+			controlID=obj.windowControlID
+			if (windowClassName,controlID) in messageListWindowKeys:
+				obj.role=controlTypes.ROLE_LISTITEM
 
 	def chooseNVDAObjectOverlayClasses(self, obj, clsList):
 		# Currently all our custom classes are IAccessible
@@ -183,7 +207,7 @@ class AppModule(appModuleHandler.AppModule):
 		if role==controlTypes.ROLE_LISTITEM and windowClassName=="OUTEXVLB":
 			clsList.insert(0, AddressBookEntry)
 			return
-		if (windowClassName=="SUPERGRID" and controlID==4704) or (windowClassName=="rctrl_renwnd32" and controlID==109):
+		if (windowClassName,controlID) in messageListWindowKeys:
 			outlookVersion=self.outlookVersion
 			if outlookVersion and outlookVersion<=9:
 				clsList.insert(0, MessageList_pre2003)
@@ -279,17 +303,13 @@ class MessageList_pre2003(IAccessible):
 				self.curMessageItem=messageItem
 				eventHandler.executeEvent("gainFocus",messageItem)
 
-	__moveByMessageGestures = (
-		"kb:downArrow",
-		"kb:upArrow",
-		"kb:home",
-		"kb:end",
-		"kb:delete",
-	)
-
-	def initOverlayClass(self):
-		for gesture in self.__moveByMessageGestures:
-			self.bindGesture(gesture, "moveByMessage")
+	__gestures={
+		"kb:downArrow":"moveByMessage",
+		"kb:upArrow":"moveByMessage",
+		"kb:home":"moveByMessage",
+		"kb:end":"moveByMessage",
+		"kb:delete":"moveByMessage",
+	}
 
 class MessageItem(Window):
 
@@ -321,17 +341,13 @@ class AddressBookEntry(IAccessible):
 		gesture.send()
 		eventHandler.queueEvent("nameChange",self)
 
-	__moveByEntryGestures = (
-		"kb:downArrow",
-		"kb:upArrow",
-		"kb:home",
-		"kb:end",
-		"kb:delete",
-	)
-
-	def initOverlayClass(self):
-		for gesture in self.__moveByEntryGestures:
-			self.bindGesture(gesture, "moveByEntry")
+	__gestures={
+		"kb:downArrow":"moveByEntry",
+		"kb:upArrow":"moveByEntry",
+		"kb:home":"moveByEntry",
+		"kb:end":"moveByEntry",
+		"kb:delete":"moveByEntry",
+	}
 
 class AutoCompleteListItem(IAccessible):
 
@@ -371,19 +387,23 @@ class CalendarView(IAccessible):
 		pass
 
 	def reportFocus(self):
-		if self.appModule.outlookVersion>=13 and self.appModule.nativeOm:
-			e=self.appModule.nativeOm.activeExplorer()
+		nativeOm=self.appModule.nativeOm
+		if nativeOm and self.appModule.outlookVersion>=13:
+			e=nativeOm.activeExplorer()
 			s=e.selection
 			if s.count>0:
-				p=s.item(1)
+				# Fetch everything needed from the appointment up front,
+				# so that a failure part way through falls back to the default report rather than raising.
 				try:
+					p=s.item(1)
 					start=p.start
 					end=p.end
+					subject=p.subject
 				except COMError:
 					return super(CalendarView,self).reportFocus()
 				t=self._generateTimeRangeText(start,end)
 				# Translators: A message reported when on a calendar appointment in Microsoft Outlook
-				ui.message(_("Appointment {subject}, {time}").format(subject=p.subject,time=t))
+				ui.message(_("Appointment {subject}, {time}").format(subject=subject,time=t))
 			else:
 				v=e.currentView
 				try:
@@ -410,16 +430,53 @@ class UIAGridRow(RowWithFakeNavigation,UIA):
 	rowHeaderText=None
 	columnHeaderText=None
 
+	#: The UIA cache request used to fetch the text children of rows, shared by all rows.
+	_childrenCacheRequest=None
+	#: A weak reference to the UIA handler L{_childrenCacheRequest} was built with.
+	#: This is weak so that a terminated handler is not kept alive.
+	_childrenCacheRequestHandlerRef=None
+
+	@staticmethod
+	def _clearChildrenCacheRequest(handlerRef):
+		"""Releases the shared children cache request once the UIA handler it was built with goes away.
+		"""
+		if handlerRef is not UIAGridRow._childrenCacheRequestHandlerRef:
+			# The request has already been rebuilt for a newer handler.
+			return
+		UIAGridRow._childrenCacheRequest=None
+		UIAGridRow._childrenCacheRequestHandlerRef=None
+
+	@staticmethod
+	def _getChildrenCacheRequest():
+		"""Fetches the cache request used to fetch the text children of rows.
+		The request is identical for every row, so it is built once and only rebuilt if the UIA handler has been reinitialized.
+		"""
+		handler=UIAHandler.handler
+		handlerRef=UIAGridRow._childrenCacheRequestHandlerRef
+		# Store on UIAGridRow itself, as instances are usually of dynamically created subclasses.
+		if UIAGridRow._childrenCacheRequest is None or not handlerRef or handlerRef() is not handler:
+			childrenCacheRequest=handler.baseCacheRequest.clone()
+			childrenCacheRequest.addProperty(UIAHandler.UIA_NamePropertyId)
+			childrenCacheRequest.addProperty(UIAHandler.UIA_TableItemColumnHeaderItemsPropertyId)
+			childrenCacheRequest.TreeScope=UIAHandler.TreeScope_Children
+			childrenCacheRequest.treeFilter=handler.clientObject.createPropertyCondition(UIAHandler.UIA_ControlTypePropertyId,UIAHandler.UIA_TextControlTypeId)
+			UIAGridRow._childrenCacheRequest=childrenCacheRequest
+			UIAGridRow._childrenCacheRequestHandlerRef=weakref.ref(handler,UIAGridRow._clearChildrenCacheRequest)
+		return UIAGridRow._childrenCacheRequest
+
 	def _get_name(self):
+		appModule=self.appModule
+		nativeOm=appModule.nativeOm
+		states=self.states
 		textList=[]
-		if controlTypes.STATE_EXPANDED in self.states:
-			textList.append(controlTypes.stateLabels[controlTypes.STATE_EXPANDED])
-		elif controlTypes.STATE_COLLAPSED in self.states:
-			textList.append(controlTypes.stateLabels[controlTypes.STATE_COLLAPSED])
+		if controlTypes.STATE_EXPANDED in states:
+			textList.append(expandedLabel)
+		elif controlTypes.STATE_COLLAPSED in states:
+			textList.append(collapsedLabel)
 		selection=None
-		if self.appModule.nativeOm:
+		if nativeOm:
 			try:
-				selection=self.appModule.nativeOm.activeExplorer().selection.item(1)
+				selection=nativeOm.activeExplorer().selection.item(1)
 			except COMError:
 				pass
 		if selection:
@@ -427,8 +484,7 @@ class UIAGridRow(RowWithFakeNavigation,UIA):
 				unread=selection.unread
 			except COMError:
 				unread=False
-			# Translators: when an email is unread
-			if unread: textList.append(_("unread"))
+			if unread: textList.append(unreadLabel)
 			try:
 				flagIcon=selection.flagIcon
 			except COMError:
@@ -439,8 +495,7 @@ class UIAGridRow(RowWithFakeNavigation,UIA):
 				attachmentCount=selection.attachments.count
 			except COMError:
 				attachmentCount=0
-			# Translators: when an email has attachments
-			if attachmentCount>0: textList.append(_("has attachment"))
+			if attachmentCount>0: textList.append(hasAttachmentLabel)
 			try:
 				importance=selection.importance
 			except COMError:
@@ -452,40 +507,37 @@ class UIAGridRow(RowWithFakeNavigation,UIA):
 			except COMError:
 				messageClass=None
 			if messageClass=="IPM.Schedule.Meeting.Request":
-				# Translators: the email is a meeting request
-				textList.append(_("meeting request"))
-		childrenCacheRequest=UIAHandler.handler.baseCacheRequest.clone()
-		childrenCacheRequest.addProperty(UIAHandler.UIA_NamePropertyId)
-		childrenCacheRequest.addProperty(UIAHandler.UIA_TableItemColumnHeaderItemsPropertyId)
-		childrenCacheRequest.TreeScope=UIAHandler.TreeScope_Children
-		childrenCacheRequest.treeFilter=UIAHandler.handler.clientObject.createPropertyCondition(UIAHandler.UIA_ControlTypePropertyId,UIAHandler.UIA_TextControlTypeId)
-		cachedChildren=self.UIAElement.buildUpdatedCache(childrenCacheRequest).getCachedChildren()
-		for index in xrange(cachedChildren.length):
+				textList.append(meetingRequestLabel)
+		cachedChildren=self.UIAElement.buildUpdatedCache(self._getChildrenCacheRequest()).getCachedChildren()
+		# Fetch this once rather than for every child.
+		reportTableHeaders=config.conf['documentFormatting']['reportTableHeaders']
+		# #6219: Outlook 2016 started exposing the draft column as a text node.
+		# Users reportedly find this extremely annoying.
+		# Thus we filter it out.
+		filterDraftFlagField=appModule.outlookVersion>=16
+		childCount=cachedChildren.length
+		childTextList=[]
+		for index in xrange(childCount):
 			e=cachedChildren.getElement(index)
-			# #6219: Outlook 2016 started exposing the draft column as a text node.
-			# Users reportedly find this extremely annoying.
-			# Thus we filter it out.
-			if self.appModule.outlookVersion>=16 and e.cachedClassName=="DraftFlagField":
+			if filterDraftFlagField and e.cachedClassName=="DraftFlagField":
 				continue
 			name=e.cachedName
-			columnHeaderTextList=[]
-			if name and config.conf['documentFormatting']['reportTableHeaders']:
+			if not name:
+				continue
+			columnHeaderText=None
+			if reportTableHeaders:
 				columnHeaderItems=e.getCachedPropertyValueEx(UIAHandler.UIA_TableItemColumnHeaderItemsPropertyId,True)
-			else:
-				columnHeaderItems=None
-			if columnHeaderItems:
-				columnHeaderItems=columnHeaderItems.QueryInterface(UIAHandler.IUIAutomationElementArray)
-				for index in xrange(columnHeaderItems.length):
-					columnHeaderItem=columnHeaderItems.getElement(index)
-					columnHeaderTextList.append(columnHeaderItem.currentName)
-			columnHeaderText=" ".join(columnHeaderTextList)
+				if columnHeaderItems:
+					# The value is a VARIANT holding an IUnknown, so this QueryInterface can't be avoided.
+					columnHeaderItems=columnHeaderItems.QueryInterface(UIAHandler.IUIAutomationElementArray)
+					columnHeaderText=" ".join(columnHeaderItems.getElement(index).currentName for index in xrange(columnHeaderItems.length))
 			if columnHeaderText:
-				text=u"{header} {name}".format(header=columnHeaderText,name=name)
+				childTextList.append(u"{header} {name}".format(header=columnHeaderText,name=name))
 			else:
-				text=name
-			if text:
-				text=text+u","
-				textList.append(text)
+				childTextList.append(name)
+		if childTextList:
+			# Each child's text is followed by a comma, including the last.
+			textList.append(u", ".join(childTextList)+u",")
 		return " ".join(textList)
 
 	value=None